@@ -1,23 +1,40 @@
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import io
+import itertools
 import logging
-import tempfile
+import mmap
+import os
+import struct
+import sys
 import zipfile
+from collections import deque
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import BinaryIO, Dict, Generator, Iterable, Iterator, Optional, Tuple
 
-VALID_SUFFIXES = {".cbz", ".zip"}
+VALID_SUFFIXES = (".cbz", ".zip")  # lowercase, a tuple so it can be passed to str.endswith
+COPY_BUFSIZE = 1 << 20  # 1 MiB, about one page image per read() and write() call
 
-logging.basicConfig(level=logging.DEBUG)
+# Parts of the zip format used by copy_member, zipfile keeps its own copies private
+FH_FILENAME_LENGTH = 10  # index of the filename length in an unpacked local file header
+FH_EXTRA_FIELD_LENGTH = 11  # index of the extra field length in the same header
+USE_DATA_DESCRIPTOR = 0x08  # flag bit: the CRC and sizes follow the data, not the header
+DATA_DESCRIPTOR_SIGNATURE = 0x08074B50
 
+logging.basicConfig(level=logging.INFO)
 
-def parse_args() -> Tuple[Path, Path, bool, bool]:
+
+def parse_args() -> Tuple[Iterator[os.DirEntry], Path, bool, int]:
     """Parse arguments
 
     Returns:
         A tuple containing:
-            The input path
+            An iterator over the cbz files in the input path
             The output path
             A boolean describing whether to force running, even if this means overwriting existing files
+            The number of cbz files to process in parallel
     """
     parser = argparse.ArgumentParser(description="get the input and output path.")
     parser.add_argument(
@@ -35,62 +52,135 @@ def parse_args() -> Tuple[Path, Path, bool, bool]:
         help="set flag to force running, even if this means overwriting existing files",
     )
     parser.add_argument("-r", action="store_true", help="set flag to run recursively")
+    parser.add_argument(
+        "-j",
+        type=int,
+        default=min(os.cpu_count() or 1, 8),
+        help="number of cbz files to process in parallel",
+    )
+    parser.add_argument(
+        "-v", action="store_true", help="set flag to log debug messages"
+    )
 
     args = parser.parse_args()
+    if args.j < 1:
+        parser.error(f"-j must be at least 1, got {args.j}")
+    if args.v:
+        logging.getLogger().setLevel(logging.DEBUG)
 
     input_path = args.input
     output_path = args.output
     force = args.f
     recurse = args.r
+    jobs = args.j
 
-    logging.info(f"Using input path: {input_path}")
-    logging.info(f"Using output: path {output_path}")
-    logging.debug(f"force: {force}")
-    logging.debug(f"recurse: {recurse}")
+    logging.info("Using input path: %s", input_path)
+    logging.info("Using output: path %s", output_path)
+    logging.debug("force: %s", force)
+    logging.debug("recurse: %s", recurse)
+    logging.debug("jobs: %s", jobs)
 
-    validate_input_path(input_path, recurse)
+    input_files = validate_input_path(input_path, recurse)
+    if input_files is None:
+        parser.error(f"no cbz files to process in input path: {input_path}")
 
-    return input_path, output_path, force, recurse
+    return input_files, output_path, force, jobs
 
 
-def validate_input_path(path: Path, recurse: bool) -> bool:
+def validate_input_path(path: Path, recurse: bool) -> Optional[Iterator[os.DirEntry]]:
     """Checks if the input path is a valid path
 
+    The cbz files are only walked once: the first one found proves the path is valid, the
+    returned iterator continues the same walk to process them.
+
     Args:
         path: the input path to validate
         recurse: whether to recurse into subdirectories
     Returns:
-        True: if the input path is a valid path
-        False: otherwise
+        An iterator over the cbz files in the input path: if the input path is a valid path
+        None: otherwise
     """
     if not path.is_dir():
         # If the path is not a directory it is invalid
-        logging.debug(f"Rejecting input path because it is not a directory: {path}")
-        return False
-    if not any(path.iterdir()):
-        # If the path is empty invalidate it
-        logging.debug(f"Rejecting input path because it is empty: {path}")
+        logging.debug("Rejecting input path because it is not a directory: %s", path)
+        return None
 
     # check for a valid file to process
-    for sub_path in path.iterdir():
-        if sub_path.is_dir() and recurse:
-            # If a path is a directory and we recurse, do so
-            logging.debug(f"Validating input sub-path: {sub_path}")
-            if validate_input_path(sub_path, recurse):
-                # if the sub_path contains valid files so does the original path
-                return True
-        else:
-            # If the path is a file
-            if sub_path.suffix in VALID_SUFFIXES:
-                logging.debug(
-                    f"Accepting input path because a valid file was found: {sub_path}"
-                )
-                return True
+    cbz_files = iter_cbz_files(path, recurse)
+    try:
+        first = next(cbz_files)
+    except StopIteration as stop:
+        # The walk ended without a valid file, it returns whether it saw any entries
+        saw_any = stop.value
+    else:
+        logging.debug(
+            "Accepting input path because a valid file was found: %s", first.path
+        )
+        return itertools.chain([first], cbz_files)
+    if not saw_any:
+        # If the path is empty invalidate it
+        logging.debug("Rejecting input path because it is empty: %s", path)
+        return None
     # No valid files where found
     logging.debug(
-        f"Rejecting input path because it contains no files with a valid suffix: {path}"
+        "Rejecting input path because it contains no files with a valid suffix: %s",
+        path,
     )
-    return False
+    return None
+
+
+def iter_cbz_files(path: Path, recurse: bool) -> Generator[os.DirEntry, None, bool]:
+    """Yields the files with a valid suffix in a path
+
+    Args:
+        path: the path to look for cbz files in
+        recurse: whether to recurse into subdirectories
+    Returns:
+        True: if the path has any entries, valid or not
+        False: if the path is empty
+    """
+    saw_any = False  # whether the path has any entries, found during the same scan
+    for entry in walk_path(path, recurse):
+        saw_any = True
+        # Iterate over all children of the path
+        if not entry.is_file():
+            # If the path is not a file, go to the next file
+            if not (recurse and entry.is_dir()):
+                # Directories are walked by walk_path if we recurse
+                logging.debug(
+                    "Not processing path because it is not a file: %s", entry.path
+                )
+            continue
+        if not entry.name.lower().endswith(VALID_SUFFIXES):
+            # If the file does not have a valid extension, go to the next file
+            logging.debug(
+                "Not processing path because it does not have a valid extension: %s",
+                entry.path,
+            )
+            logging.debug("Valid extensions are: %s", VALID_SUFFIXES)
+            continue
+        yield entry
+    return saw_any
+
+
+def walk_path(path: Path, recurse: bool) -> Iterator[os.DirEntry]:
+    """Yields the entries of a path, including those of its subdirectories if recurse is set.
+    Subdirectories are kept on a stack instead of being walked recursively.
+
+    Args:
+        path: the path to walk
+        recurse: whether to walk into subdirectories
+    """
+    directories = deque([path])
+    while directories:
+        directory = directories.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if recurse and entry.is_dir():
+                    # If the entry is a directory and we recurse, walk it later
+                    logging.debug("recursing into directory: %s", entry.path)
+                    directories.append(entry.path)
+                yield entry
 
 
 def validate_output_path(path: Path, force: bool) -> bool:
@@ -106,7 +196,10 @@ def validate_output_path(path: Path, force: bool) -> bool:
     if not path.exists():
         logging.debug("Accepting output path because it does not yet exist")
         return True
-    if not any(path.iterdir()):
+    with os.scandir(path) as entries:
+        # Only peek at the first entry, without creating a Path for it
+        empty = next(entries, None) is None
+    if empty:
         logging.debug("Accepting output path because it is empty")
         return True
     if force:
@@ -117,93 +210,248 @@ def validate_output_path(path: Path, force: bool) -> bool:
     return False
 
 
-def process_path(input_path: Path, output_path: Path, force: bool, recurse: bool):
-    """Run the program on a path"""
-    for file in input_path.iterdir():
-        # Iterate over all direct children of the input path
-        if not file.is_file():
-            # If the path is not a file, go to the next file
-            if recurse and file.is_dir():
-                # If the path is a directory and we need to recurse, recurse
-                logging.debug(f"recursing into directory: {file}")
-                process_path(file, output_path, force, recurse)
-            else:
-                logging.debug(f"Not processing path because it is not a file: {file}")
-                continue
-        if not file.suffix.lower() in VALID_SUFFIXES:
-            # If the file does not have a valid extension, go to the next file
-            logging.debug(
-                f"Not processing path because it does not have a valid extension: {file}"
-            )
-            logging.debug(f"Valid extensions are: {VALID_SUFFIXES}")
-            continue
-        output_file = output_path.joinpath(file.name)
-        if output_file.is_file() and not force:
+def process_path(
+    input_files: Iterable[os.DirEntry], output_path: Path, force: bool, jobs: int
+) -> int:
+    """Run the program on the cbz files of a path
+
+    The cbz files to rebuild are collected first and then rebuilt in parallel, as every cbz
+    can be rebuilt independently of the others.
+
+    Returns:
+        The number of cbz files that failed to rebuild
+    """
+    # Paths below are kept as plain strings, as pathlib would parse and allocate for every entry
+    output_dir = os.fspath(output_path)
+    work: Dict[str, str] = dict()  # maps output files to the input file to rebuild
+    for entry in input_files:
+        file = entry.path
+        output_file = os.path.join(output_dir, entry.name)
+        if (output_file in work or os.path.isfile(output_file)) and not force:
             # If the output file already exists
             logging.debug(
-                f"Not processing file '{file}' because the output file already exists: {output_file}"
+                "Not processing file '%s' because the output file already exists: %s",
+                file,
+                output_file,
             )
             continue
-        output_path.mkdir(
-            exist_ok=True, parents=True
-        )  # If the output_dir does not exist, create it
-        rebuild_cbz(file, output_file)
+        work[output_file] = file
+
+    if not work:
+        return 0
+    output_path.mkdir(
+        exist_ok=True, parents=True
+    )  # If the output_dir does not exist, create it
+    rebuilt = failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(rebuild_cbz, file, output_file): file
+            for output_file, file in work.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            file = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Failed to rebuild cbz: %s", file)
+                failures += 1
+                continue
+            rebuilt += 1
+            logging.info("Rebuilt cbz (%d/%d): %s", rebuilt, len(futures), file)
+    if failures:
+        logging.error("Failed to rebuild %d of %d cbz files", failures, len(futures))
+    return failures
 
 
-def rebuild_cbz(input_file: Path, output_file: Path):
+def rebuild_cbz(input_file: str, output_file: str):
     """Create a new cbz file with the new naming structure
 
     Args:
         input_file: The original cbz file
         output_file: The new file to write to
     """
-    # TODO: Write directly from zip to zip and skip the temp directory
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_dir = Path(tmp_dir)
-        with zipfile.ZipFile(input_file) as original_cbz:
-            original_cbz.extractall(tmp_dir)
-        mapping = build_rename_mapping(tmp_dir)
-        with zipfile.ZipFile(output_file, mode="w") as new_cbz:
-            for (
-                file,
-                new_path,
-            ) in mapping.items():  # TODO: check if we need to set a compression level
-                new_cbz.write(
-                    file, arcname=new_path
-                )  # TODO: check if we need to set a compression level
+    # Write to a .part file first, so an interrupted run never leaves a half-written cbz
+    # behind that would be skipped as already processed on the next run
+    part_file = output_file + ".part"
+    try:
+        with open(input_file, "rb") as original_file:
+            if not os.fstat(original_file.fileno()).st_size:
+                # An empty file can not be memory mapped, report it like zipfile would
+                raise zipfile.BadZipFile("File is not a zip file")
+            with mmap.mmap(
+                original_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as original_map:
+                # zipfile reads the central directory and local file headers in many
+                # small reads, from a memory map these are served by page faults instead
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    original_map.madvise(mmap.MADV_SEQUENTIAL)
+                try:
+                    original_cbz = zipfile.ZipFile(original_map)
+                except ValueError as error:
+                    # A memory map raises ValueError when seeking out of range, where a
+                    # file raises the OSError that zipfile reports as BadZipFile
+                    raise zipfile.BadZipFile("File is not a zip file") from error
+                # Members are copied with their original compression by copy_member.
+                # The archive itself is opened with ZIP_STORED so nothing written
+                # through zipfile is ever deflated: cbz files hold already compressed
+                # images, which DEFLATE can not shrink any further.
+                with original_cbz, zipfile.ZipFile(
+                    part_file,
+                    mode="w",
+                    compression=zipfile.ZIP_STORED,
+                    compresslevel=None,
+                    allowZip64=True,
+                ) as new_cbz:
+                    # Rename and copy every member in one pass over the central directory
+                    for info in original_cbz.infolist():
+                        if info.is_dir():
+                            # directories are implied by the files inside them, skip them
+                            continue
+                        new_path = rename_member(info.filename)
+                        if not new_path:
+                            # Nothing is left of the name once it is sanitized
+                            logging.warning(
+                                "Skipping member without a valid name: %s",
+                                info.filename,
+                            )
+                            continue
+                        copy_member(
+                            original_map, original_file, info, new_cbz, new_path
+                        )
+        os.replace(part_file, output_file)
+    except BaseException:
+        # Also clean up when interrupted with Ctrl-C
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part_file)
+        raise
 
 
-def build_rename_mapping(path: Path, prefix: Optional[Path] = None) -> Dict[Path, Path]:
-    """Returns a map with the original path/filenames as a key and the new path/filenames as value.
-    The purpose of this function is to provide the new file structure of the cbz.
+def rename_member(filename: str) -> str:
+    """Returns the new path of a cbz member.
+    The new path keeps the directory, the entire zip path goes in the filename. Like
+    extracting the member would, empty, "." and ".." path components are dropped, so the
+    new path is never absolute and never points outside of the cbz.
 
     Args:
-        path: the (sub)path to process renames of)
-        prefix: the part of theopath to ignore when renaming
+        filename: The path of the member inside the original cbz
+    Returns:
+        The new path, or an empty string if no valid path components are left
     """
-    if prefix is None:
-        # if no prefix is given, assume the path is the prefix
-        prefix = path
-    mapping = dict()
-    for sub_path in path.iterdir():
-        if sub_path.is_dir():
-            # if the sub-path is a directory, process it recursively
-            mapping.update(build_rename_mapping(sub_path, prefix))
-            continue
-        if not sub_path.is_file():
-            # if the sub_path is not a file or directory, skip it
-            continue
-        # create a mapping from the original path to a single filename with the
-        zip_path = sub_path.relative_to(
-            prefix
-        )  # The path the file had inside the zipfile
-        # map the original path to a new path where entire zip_path is inside the filename
-        mapping[sub_path] = zip_path.parent.joinpath(
-            str(zip_path.as_posix()).replace("/", "_")
+    parts = [part for part in filename.split("/") if part not in ("", ".", "..")]
+    if not parts:
+        return ""
+    return "/".join(parts[:-1] + ["_".join(parts)])
+
+
+def copy_member(
+    original_map: mmap.mmap,
+    original_file: BinaryIO,
+    info: zipfile.ZipInfo,
+    new_cbz: zipfile.ZipFile,
+    new_path: str,
+):
+    """Copy a member from one cbz to another without decompressing it.
+    The compressed bytes are copied as-is, so the compression method, CRC, sizes and
+    timestamps of the original member are kept.
+
+    Args:
+        original_map: The memory map of the cbz to copy the member from
+        original_file: The file behind original_map, the compressed data is copied from it
+        info: The member to copy
+        new_cbz: The cbz to copy the member to
+        new_path: The path of the member inside the new cbz
+    """
+    # Skip the local file header to get to the compressed data
+    # The header is sliced from the map: seeking a map out of range raises ValueError,
+    # and a negative offset from a damaged central directory would wrap around
+    header_end = info.header_offset + zipfile.sizeFileHeader
+    if info.header_offset < 0 or header_end > len(original_map):
+        raise zipfile.BadZipFile("Truncated file header")
+    header = struct.unpack(
+        zipfile.structFileHeader, original_map[info.header_offset : header_end]
+    )
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad magic number for file header: {info.filename}")
+    original_file.seek(
+        header_end + header[FH_FILENAME_LENGTH] + header[FH_EXTRA_FIELD_LENGTH]
+    )
+
+    new_info = copy.copy(info)
+    new_info.filename = new_path
+    # The extra fields may contain the old (unicode) path, drop them
+    new_info.extra = b""
+    new_info.header_offset = new_cbz.fp.tell()
+    zip64 = (
+        info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    )
+    new_cbz.fp.write(new_info.FileHeader(zip64))
+    if copy_range(original_file, new_cbz.fp, info.compress_size) != info.compress_size:
+        raise EOFError(f"Unexpected end of data: {info.filename}")
+    if new_info.flag_bits & USE_DATA_DESCRIPTOR:
+        # The header has no CRC and sizes, write them after the data like the original
+        new_cbz.fp.write(
+            struct.pack(
+                "<LLQQ" if zip64 else "<LLLL",
+                DATA_DESCRIPTOR_SIGNATURE,
+                info.CRC,
+                info.compress_size,
+                info.file_size,
+            )
         )
-    return mapping
+
+    # Register the member so it is written to the central directory on close
+    new_cbz.filelist.append(new_info)
+    new_cbz.NameToInfo[new_info.filename] = new_info
+    new_cbz.start_dir = new_cbz.fp.tell()
+
+
+def copy_range(src: BinaryIO, dst: BinaryIO, length: int) -> int:
+    """Copy bytes from the current position of one file to the current position of another.
+    Where possible os.copy_file_range is used, so the kernel copies the data without it
+    passing through Python. Otherwise, the data is copied in chunks.
+
+    Args:
+        src: The file to copy from
+        dst: The file to copy to
+        length: The number of bytes to copy
+    Returns:
+        The number of bytes copied, which is less than length if src ended early
+    """
+    src_offset = src.tell()
+    dst.flush()
+    dst_offset = dst.tell()
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            while copied < length:
+                count = os.copy_file_range(
+                    src_fd,
+                    dst_fd,
+                    length - copied,
+                    src_offset + copied,
+                    dst_offset + copied,
+                )
+                if not count:
+                    # src ended early
+                    break
+                copied += count
+        except (AttributeError, io.UnsupportedOperation, OSError):
+            # The files have no file descriptor, or the kernel or file system can not copy
+            # between them. Copy whatever is left in chunks instead
+            pass
+    src.seek(src_offset + copied)
+    dst.seek(dst_offset + copied)
+    while copied < length:
+        chunk = src.read(min(length - copied, COPY_BUFSIZE))
+        if not chunk:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+    return copied
 
 
 if __name__ == "__main__":
-    input_path, output_path, force, recurse = parse_args()
-    process_path(input_path, output_path, force, recurse)
+    input_files, output_path, force, jobs = parse_args()
+    if process_path(input_files, output_path, force, jobs):
+        sys.exit(1)
@@ -0,0 +1,459 @@
+import errno
+import io
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+from main import (
+    COPY_BUFSIZE,
+    copy_range,
+    iter_cbz_files,
+    parse_args,
+    process_path,
+    rebuild_cbz,
+    validate_input_path,
+)
+
+
+class NonSeekableWriter(io.RawIOBase):
+    """A write-only stream, makes zipfile write data descriptors after each member"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def write_members(cbz: zipfile.ZipFile):
+    """Write members with every compression method and naming case to a cbz"""
+    cbz.writestr("ComicInfo.xml", "<ComicInfo/>" * 50, zipfile.ZIP_DEFLATED)
+    cbz.writestr("chapter 1/", "")
+    cbz.writestr("chapter 1/page 1.jpg", os.urandom(4096), zipfile.ZIP_STORED)
+    cbz.writestr("chapter 1/page 2.png", b"png" * 4096, zipfile.ZIP_DEFLATED)
+    cbz.writestr("chapter 2/extra/page 1.jpg", b"jpg" * 4096, zipfile.ZIP_BZIP2)
+    cbz.writestr("chapter 2/ページ.jpg", b"utf-8" * 1024, zipfile.ZIP_DEFLATED)
+    with cbz.open(
+        zipfile.ZipInfo("chapter 2/page 3.jpg"), mode="w", force_zip64=True
+    ) as member:
+        member.write(b"zip64" * 1024)
+    # Names that extracting would sanitize
+    cbz.writestr("/absolute/page 1.jpg", b"absolute" * 512, zipfile.ZIP_STORED)
+    cbz.writestr("../outside.jpg", b"outside" * 512, zipfile.ZIP_STORED)
+    cbz.writestr("./chapter 3//page 1.jpg", b"dot" * 512, zipfile.ZIP_STORED)
+
+
+def valid_cbz() -> bytearray:
+    """Returns the bytes of a small valid cbz"""
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, mode="w") as cbz:
+        cbz.writestr("chapter 1/page 1.jpg", b"jpg" * 1024)
+        cbz.writestr("chapter 1/page 2.jpg", b"jpg" * 1024)
+    return bytearray(stream.getvalue())
+
+
+def set_header_offset(data: bytearray, header_offset: int) -> bytearray:
+    """Points the first central directory entry of a cbz at another local header"""
+    struct.pack_into("<L", data, data.find(b"PK\x01\x02") + 42, header_offset)
+    return data
+
+
+def truncated_header_cbz() -> bytearray:
+    """Returns a cbz with a local file header that is cut off by the end of file"""
+    data = valid_cbz()
+    return set_header_offset(data, len(data) - 10)
+
+
+EXPECTED_NAMES = {
+    "ComicInfo.xml": "ComicInfo.xml",
+    "chapter 1/page 1.jpg": "chapter 1/chapter 1_page 1.jpg",
+    "chapter 1/page 2.png": "chapter 1/chapter 1_page 2.png",
+    "chapter 2/extra/page 1.jpg": "chapter 2/extra/chapter 2_extra_page 1.jpg",
+    "chapter 2/ページ.jpg": "chapter 2/chapter 2_ページ.jpg",
+    "chapter 2/page 3.jpg": "chapter 2/chapter 2_page 3.jpg",
+    "/absolute/page 1.jpg": "absolute/absolute_page 1.jpg",
+    "../outside.jpg": "outside.jpg",
+    "./chapter 3//page 1.jpg": "chapter 3/chapter 3_page 1.jpg",
+}
+
+
+class RebuildCbzTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def assert_rebuilt(self, input_file: str):
+        """Rebuild a cbz and check the new names and that the members are unchanged"""
+        output_file = os.path.join(self.tmp_dir, "output.cbz")
+        rebuild_cbz(input_file, output_file)
+        self.assertFalse(os.path.exists(output_file + ".part"))
+        with zipfile.ZipFile(input_file) as original_cbz, zipfile.ZipFile(
+            output_file
+        ) as new_cbz:
+            self.assertIsNone(new_cbz.testzip())
+            self.assertEqual(
+                sorted(new_cbz.namelist()), sorted(EXPECTED_NAMES.values())
+            )
+            for name, new_name in EXPECTED_NAMES.items():
+                info = original_cbz.getinfo(name)
+                new_info = new_cbz.getinfo(new_name)
+                self.assertEqual(new_info.compress_type, info.compress_type)
+                self.assertEqual(new_cbz.read(new_info), original_cbz.read(info))
+            with open(output_file, "rb") as file:
+                data = file.read()
+            for new_info in new_cbz.infolist():
+                # The member data must be followed by its data descriptor if it has one,
+                # and otherwise directly by the next member or the central directory
+                name_length, extra_length = struct.unpack_from(
+                    "<HH", data, new_info.header_offset + 26
+                )
+                end = (
+                    new_info.header_offset
+                    + 30
+                    + name_length
+                    + extra_length
+                    + new_info.compress_size
+                )
+                if new_info.flag_bits & 0x08:
+                    self.assertEqual(data[end : end + 4], b"PK\x07\x08")
+                else:
+                    self.assertIn(
+                        data[end : end + 4], (b"PK\x03\x04", b"PK\x01\x02")
+                    )
+
+    def test_rebuild_cbz(self):
+        input_file = os.path.join(self.tmp_dir, "input.cbz")
+        with zipfile.ZipFile(input_file, mode="w") as cbz:
+            write_members(cbz)
+        self.assert_rebuilt(input_file)
+
+    def test_rebuild_cbz_with_data_descriptors(self):
+        stream = NonSeekableWriter()
+        with zipfile.ZipFile(stream, mode="w") as cbz:
+            write_members(cbz)
+        input_file = os.path.join(self.tmp_dir, "input.cbz")
+        with open(input_file, "wb") as file:
+            file.write(stream.data)
+        self.assert_rebuilt(input_file)
+
+    def test_rebuild_cbz_rejects_invalid_files(self):
+        for data, message in (
+            (b"", "File is not a zip file"),
+            (b"not a zip file", "File is not a zip file"),
+            (truncated_header_cbz(), "Truncated file header"),
+            # With its start cut off, the first member's offset becomes negative
+            (valid_cbz()[40:], "Truncated file header"),
+            (set_header_offset(valid_cbz(), 1 << 20), "Truncated file header"),
+        ):
+            input_file = os.path.join(self.tmp_dir, "input.cbz")
+            with open(input_file, "wb") as file:
+                file.write(data)
+            output_file = os.path.join(self.tmp_dir, "output.cbz")
+            with self.assertRaisesRegex(zipfile.BadZipFile, message):
+                rebuild_cbz(input_file, output_file)
+            self.assertFalse(os.path.exists(output_file + ".part"))
+
+
+
+class CopyRangeTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        # Large enough to take several chunks when copy_file_range can not be used
+        self.data = os.urandom(3 * COPY_BUFSIZE + 123)
+        self.src_file = os.path.join(tmp_dir.name, "src")
+        self.dst_file = os.path.join(tmp_dir.name, "dst")
+        with open(self.src_file, "wb") as file:
+            file.write(b"header" + self.data + b"trailer")
+
+    def copy(self, length: int) -> int:
+        """Copy from behind the header of src to behind a prefix in dst"""
+        with open(self.src_file, "rb") as src, open(self.dst_file, "w+b") as dst:
+            src.seek(len(b"header"))
+            dst.write(b"prefix")  # still buffered, copy_range has to flush it
+            copied = copy_range(src, dst, length)
+            self.assertEqual(src.tell(), len(b"header") + copied)
+            dst.write(b"suffix")
+        return copied
+
+    def assert_copied(self, data: bytes):
+        with open(self.dst_file, "rb") as file:
+            self.assertEqual(file.read(), b"prefix" + data + b"suffix")
+
+    def test_copy_range(self):
+        self.assertEqual(self.copy(len(self.data)), len(self.data))
+        self.assert_copied(self.data)
+
+    def test_copy_range_falls_back_to_chunks(self):
+        with mock.patch(
+            "os.copy_file_range",
+            side_effect=OSError(errno.EXDEV, "Invalid cross-device link"),
+            create=True,
+        ):
+            self.assertEqual(self.copy(len(self.data)), len(self.data))
+        self.assert_copied(self.data)
+
+    @unittest.skipUnless(hasattr(os, "copy_file_range"), "requires os.copy_file_range")
+    def test_copy_range_resumes_after_partial_copy(self):
+        copy_file_range = os.copy_file_range
+        calls = []
+
+        def partial_copy_file_range(src, dst, count, offset_src, offset_dst):
+            # Copy a bit more than one chunk, then fail like a file system that gave up
+            calls.append(count)
+            if len(calls) > 1:
+                raise OSError(errno.EINVAL, "Invalid argument")
+            return copy_file_range(src, dst, COPY_BUFSIZE + 7, offset_src, offset_dst)
+
+        with mock.patch("os.copy_file_range", partial_copy_file_range):
+            self.assertEqual(self.copy(len(self.data)), len(self.data))
+        self.assertEqual(len(calls), 2)
+        self.assert_copied(self.data)
+
+    def test_copy_range_stops_at_end_of_src(self):
+        length = len(self.data) + len(b"trailer")
+        self.assertEqual(self.copy(length + 100), length)
+        self.assert_copied(self.data + b"trailer")
+
+    def test_copy_range_fallback_stops_at_end_of_src(self):
+        length = len(self.data) + len(b"trailer")
+        with mock.patch("os.copy_file_range", side_effect=OSError, create=True):
+            self.assertEqual(self.copy(length + 100), length)
+        self.assert_copied(self.data + b"trailer")
+
+
+
+class ValidateInputPathTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def make_tree(self, *files: str) -> str:
+        """Create a directory with empty files (and their directories) inside it"""
+        path = tempfile.mkdtemp(dir=self.tmp_dir)
+        for file in files:
+            file = os.path.join(path, file)
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            open(file, "wb").close()
+        return path
+
+    def validate(self, path: str, recurse: bool):
+        """Returns the sorted cbz files found in a path, or None if it is invalid"""
+        cbz_files = validate_input_path(Path(path), recurse)
+        if cbz_files is None:
+            return None
+        return sorted(os.path.relpath(entry.path, path) for entry in cbz_files)
+
+    def assert_rejected(self, path: str, recurse: bool, reason: str, saw_any: bool):
+        with self.assertLogs(level="DEBUG") as logs:
+            self.assertIsNone(self.validate(path, recurse))
+        self.assertIn(f"Rejecting input path because {reason}", logs.output[-1])
+        # The walk itself tells an empty path apart from one without cbz files
+        cbz_files = iter_cbz_files(Path(path), recurse)
+        with self.assertRaises(StopIteration) as stop:
+            next(cbz_files)
+        self.assertIs(stop.exception.value, saw_any)
+
+    def test_empty_path(self):
+        path = self.make_tree()
+        for recurse in (False, True):
+            self.assert_rejected(path, recurse, "it is empty", saw_any=False)
+
+    def test_path_without_cbz_files(self):
+        path = self.make_tree("readme.txt", "chapter 1/page 1.jpg", "archive.cbz.txt")
+        for recurse in (False, True):
+            self.assert_rejected(
+                path, recurse, "it contains no files with a valid suffix", saw_any=True
+            )
+
+    def test_path_that_is_not_a_directory(self):
+        path = os.path.join(self.make_tree("volume 1.cbz"), "volume 1.cbz")
+        self.assertIsNone(self.validate(path, recurse=False))
+
+    def test_flat_path(self):
+        path = self.make_tree(
+            "volume 1.cbz", "volume 2.ZIP", "readme.txt", "extra/volume 3.cbz"
+        )
+        # Every cbz file is returned exactly once, including the one used to validate
+        self.assertEqual(
+            self.validate(path, recurse=False), ["volume 1.cbz", "volume 2.ZIP"]
+        )
+
+    def test_recursive_path(self):
+        path = self.make_tree(
+            "volume 1.cbz",
+            "volume 2.ZIP",
+            "readme.txt",
+            "extra/volume 3.cbz",
+            "extra/more/volume 4.zip",
+        )
+        self.assertEqual(
+            self.validate(path, recurse=True),
+            [
+                os.path.join("extra", "more", "volume 4.zip"),
+                os.path.join("extra", "volume 3.cbz"),
+                "volume 1.cbz",
+                "volume 2.ZIP",
+            ],
+        )
+
+    def test_cbz_files_only_in_subdirectories(self):
+        path = self.make_tree("readme.txt", "extra/volume 1.cbz")
+        self.assert_rejected(
+            path, False, "it contains no files with a valid suffix", saw_any=True
+        )
+        self.assertEqual(
+            self.validate(path, recurse=True), [os.path.join("extra", "volume 1.cbz")]
+        )
+
+    def test_parse_args(self):
+        path = self.make_tree("volume 1.cbz", "extra/volume 2.cbz")
+        output = os.path.join(self.tmp_dir, "output")
+        with mock.patch.object(sys, "argv", ["main.py", "-r", path, output]):
+            with self.assertLogs(level="INFO"):
+                input_files, output_path, force, jobs = parse_args()
+        self.assertEqual(
+            sorted(entry.name for entry in input_files),
+            ["volume 1.cbz", "volume 2.cbz"],
+        )
+        self.assertEqual(output_path, Path(output))
+        self.assertFalse(force)
+
+    def test_parse_args_rejects_path_without_cbz_files(self):
+        for path in (self.make_tree(), self.make_tree("readme.txt")):
+            argv = ["main.py", path, os.path.join(self.tmp_dir, "output")]
+            with mock.patch.object(sys, "argv", argv), mock.patch.object(
+                sys, "stderr", io.StringIO()
+            ) as stderr, self.assertRaises(SystemExit) as error, self.assertLogs(
+                level="INFO"
+            ):
+                parse_args()
+            self.assertEqual(error.exception.code, 2)
+            self.assertIn("no cbz files to process", stderr.getvalue())
+
+
+
+class ProcessPathTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.input_path = os.path.join(tmp_dir.name, "input")
+        self.output_path = os.path.join(tmp_dir.name, "output")
+
+    def write_cbz(self, file: str, page: str):
+        """Write a cbz with a single page to the input path"""
+        file = os.path.join(self.input_path, file)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with zipfile.ZipFile(file, mode="w") as cbz:
+            cbz.writestr(page, page.encode())
+
+    def entries(self, *files: str):
+        """Returns the os.DirEntry objects of input files, in the given order"""
+        entries = []
+        for file in files:
+            directory, name = os.path.split(os.path.join(self.input_path, file))
+            with os.scandir(directory) as directory_entries:
+                entries.extend(
+                    entry for entry in directory_entries if entry.name == name
+                )
+        return entries
+
+    def output_pages(self, file: str):
+        with zipfile.ZipFile(os.path.join(self.output_path, file)) as cbz:
+            return cbz.namelist()
+
+    def process(self, *files: str, force: bool = False) -> int:
+        with self.assertLogs(level="INFO") as logs:
+            failures = process_path(
+                self.entries(*files), Path(self.output_path), force, jobs=2
+            )
+        self.logs = logs.output
+        return failures
+
+    def test_same_output_file_without_force(self):
+        self.write_cbz("first/volume 1.cbz", "first.jpg")
+        self.write_cbz("second/volume 1.cbz", "second.jpg")
+        files = ("first/volume 1.cbz", "second/volume 1.cbz")
+        self.assertEqual(self.process(*files), 0)
+        # The first input file wins, and is rebuilt only once
+        self.assertEqual(self.output_pages("volume 1.cbz"), ["first.jpg"])
+        self.assertEqual(len(self.logs), 1)
+        self.assertIn("Rebuilt cbz (1/1)", self.logs[0])
+        # An existing output file is not rebuilt again
+        self.write_cbz("third/volume 1.cbz", "third.jpg")
+        with mock.patch("main.concurrent.futures.ProcessPoolExecutor") as executor:
+            self.assertEqual(
+                process_path(
+                    self.entries("third/volume 1.cbz"),
+                    Path(self.output_path),
+                    False,
+                    jobs=2,
+                ),
+                0,
+            )
+        executor.assert_not_called()
+        self.assertEqual(self.output_pages("volume 1.cbz"), ["first.jpg"])
+
+    def test_same_output_file_with_force(self):
+        self.write_cbz("first/volume 1.cbz", "first.jpg")
+        self.write_cbz("second/volume 1.cbz", "second.jpg")
+        files = ("first/volume 1.cbz", "second/volume 1.cbz")
+        self.assertEqual(self.process(*files, force=True), 0)
+        # The last input file wins, and is rebuilt only once
+        self.assertEqual(self.output_pages("volume 1.cbz"), ["second.jpg"])
+        self.assertEqual(len(self.logs), 1)
+        self.assertEqual(self.process(*files[:1], force=True), 0)
+        self.assertEqual(self.output_pages("volume 1.cbz"), ["first.jpg"])
+
+    def test_failures_are_counted(self):
+        self.write_cbz("volume 1.cbz", "page 1.jpg")
+        for name in ("volume 2.cbz", "volume 3.cbz"):
+            with open(os.path.join(self.input_path, name), "wb") as file:
+                file.write(b"not a zip file")
+        files = ("volume 1.cbz", "volume 2.cbz", "volume 3.cbz")
+        self.assertEqual(self.process(*files), 2)
+        self.assertEqual(sorted(os.listdir(self.output_path)), ["volume 1.cbz"])
+        # Progress only counts the cbz files that were rebuilt
+        self.assertIn("Rebuilt cbz (1/3)", "".join(self.logs))
+        self.assertNotIn("Rebuilt cbz (2/3)", "".join(self.logs))
+        self.assertIn("Failed to rebuild 2 of 3 cbz files", self.logs[-1])
+
+    def run_main(self, *args: str) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            [sys.executable, os.path.join(os.path.dirname(__file__), "main.py"), *args],
+            capture_output=True,
+            text=True,
+        )
+
+    def test_exit_status(self):
+        self.write_cbz("volume 1.cbz", "page 1.jpg")
+        self.assertEqual(self.run_main(self.input_path, self.output_path).returncode, 0)
+        with open(os.path.join(self.input_path, "volume 2.cbz"), "wb") as file:
+            file.write(b"not a zip file")
+        result = self.run_main(self.input_path, self.output_path)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("Failed to rebuild 1 of 1 cbz files", result.stderr)
+
+    def test_jobs_must_be_positive(self):
+        self.write_cbz("volume 1.cbz", "page 1.jpg")
+        for jobs in ("0", "-1"):
+            result = self.run_main("-j", jobs, self.input_path, self.output_path)
+            self.assertEqual(result.returncode, 2)
+            self.assertIn("-j must be at least 1", result.stderr)
+        self.assertFalse(os.path.exists(self.output_path))
+
+
+if __name__ == "__main__":
+    unittest.main()